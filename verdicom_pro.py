@@ -3,7 +3,9 @@ VERDICOM PRO - Interactive DICOM Viewer in Streamlit
 Ready to run:
     streamlit run verdicom.py
 Requirements:
-    pip install streamlit pydicom numpy matplotlib pillow
+    pip install streamlit pydicom numpy pillow
+Optional (faster windowing LUT, true CLAHE):
+    pip install numba scikit-image
 """
 
 # ==============================
@@ -12,12 +14,23 @@ Requirements:
 import streamlit as st
 import pydicom
 import numpy as np
-import matplotlib.pyplot as plt
 from PIL import Image, ImageOps
 import io
-import base64
+import hashlib
 from datetime import datetime
 
+# numba es opcional: acelera la construcción y el gather del LUT si está instalado
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# scikit-image es opcional: CLAHE real; sin él se usa la ecualización global de Pillow
+try:
+    from skimage.exposure import equalize_adapthist
+except ImportError:
+    equalize_adapthist = None
+
 # ==============================
 # 🧩 ESTILO (CSS INLINE)
 # ==============================
@@ -91,40 +104,107 @@ main .block-container {
 </style>
 """
 
+# st.download_button acepta un callable en data (generación diferida) desde 1.52
+_DEFERRED_DOWNLOAD = tuple(int(v) for v in st.__version__.split(".")[:2]) >= (1, 52)
+
 st.set_page_config(page_title="VERDICOM PRO", layout="wide", initial_sidebar_state="auto")
 st.markdown(_BASE_CSS, unsafe_allow_html=True)
 
 
-@st.cache_data(show_spinner=False)
-def load_dicom(file) -> pydicom.dataset.FileDataset:
+def load_dicom(file, stop_before_pixels: bool = True) -> pydicom.dataset.FileDataset:
     """
     Reads a DICOM file from Streamlit's uploader and returns the dataset.
     file: UploadedFile or file-like
+    By default only the metadata is read (stops before Pixel Data); see decode_pixels.
     """
     try:
-        ds = pydicom.dcmread(file, force=False)
+        file.seek(0)
+        ds = pydicom.dcmread(file, force=False, stop_before_pixels=stop_before_pixels)
         return ds
     except Exception as e:
         file.seek(0)
         raw = file.read()
         bio = io.BytesIO(raw)
-        ds = pydicom.dcmread(bio, force=True)
+        ds = pydicom.dcmread(bio, force=True, stop_before_pixels=stop_before_pixels)
         return ds
 
-def get_pixel_array(ds: pydicom.dataset.FileDataset) -> np.ndarray:
+def decode_pixels(file) -> np.ndarray:
     """
-    Extracts the pixel array and converts it to float (normalized internally).
+    Reads the full file and decodes its pixel data. Kept separate from load_dicom
+    so the metadata panel renders before the (often dominant) pixel decode.
+    """
+    return load_dicom(file, stop_before_pixels=False).pixel_array
+
+def get_rescale(ds: pydicom.dataset.FileDataset) -> tuple:
+    """
+    Returns (slope, intercept) of the modality rescale, defaulting to identity.
     """
-    arr = ds.pixel_array.astype(np.float32)
-    intercept = float(getattr(ds, 'RescaleIntercept', 0.0))
     slope = float(getattr(ds, 'RescaleSlope', 1.0))
-    arr = arr * slope + intercept
+    intercept = float(getattr(ds, 'RescaleIntercept', 0.0))
+    return slope, intercept
+
+def stored_range(ds: pydicom.dataset.FileDataset, rescale: tuple):
+    """
+    (min, max) of the rescaled values representable with BitsStored and
+    PixelRepresentation; O(1), no reduction over the pixel array.
+    Returns None if BitsStored is missing.
+    """
+    bits = getattr(ds, 'BitsStored', None)
+    if not bits:
+        return None
+    bits = int(bits)
+    if int(getattr(ds, 'PixelRepresentation', 0)) == 0:
+        lo, hi = 0, 2 ** bits - 1
+    else:
+        lo, hi = -(2 ** (bits - 1)), 2 ** (bits - 1) - 1
+    slope, intercept = rescale
+    lo, hi = sorted((lo * slope + intercept, hi * slope + intercept))
+    return float(lo), float(hi)
+
+def lut_compatible(ds: pydicom.dataset.FileDataset, raw: np.ndarray) -> bool:
+    """
+    True when the stored (pre-rescale) pixels can be windowed with a lookup table:
+    MONOCHROME images with integer samples of at most 16 bits.
+    """
+    photometric = str(getattr(ds, 'PhotometricInterpretation', 'MONOCHROME2'))
+    if not photometric.startswith('MONOCHROME'):
+        return False
+    return raw.dtype.kind in 'ui' and raw.dtype.itemsize <= 2
+
+def get_frames(ds: pydicom.dataset.FileDataset, raw: np.ndarray) -> np.ndarray:
+    """
+    Returns the stored pixel data raw as a C-contiguous (frames, rows, cols[, samples])
+    array, so each frame is one contiguous slab. Single-frame images get frames=1.
+    """
+    n_frames = int(getattr(ds, 'NumberOfFrames', 1) or 1)
+    if n_frames <= 1 or raw.shape[0] != n_frames:
+        raw = raw[np.newaxis]
+    return np.ascontiguousarray(raw)
+
+def rescale_array(raw: np.ndarray, slope: float, intercept: float) -> np.ndarray:
+    """
+    Applies the modality rescale (slope/intercept) to stored pixel values.
+    With identity rescale the native array (e.g. uint16) is returned as-is;
+    otherwise a single float32 copy is rescaled in place.
+    """
+    if slope == 1.0 and intercept == 0.0:
+        return raw
+    arr = raw.astype(np.float32)
+    np.multiply(arr, slope, out=arr)
+    arr += intercept
     return arr
 
-def default_window(ds: pydicom.dataset.FileDataset):
+def get_pixel_array(ds: pydicom.dataset.FileDataset) -> np.ndarray:
+    """
+    Extracts the pixel array and applies the modality rescale (slope/intercept).
+    """
+    return rescale_array(ds.pixel_array, *get_rescale(ds))
+
+def default_window(ds: pydicom.dataset.FileDataset, arr: np.ndarray = None):
     """
     Gets WindowCenter and WindowWidth from DICOM if available; returns (center, width).
     If missing, computes them from percentiles of the pixel array.
+    arr: already decoded pixel array (avoids decoding ds again in the fallback).
     """
     wc = None; ww = None
     if hasattr(ds, 'WindowCenter') and hasattr(ds, 'WindowWidth'):
@@ -140,9 +220,9 @@ def default_window(ds: pydicom.dataset.FileDataset):
             ww = float(ww)
         return wc, ww
     # fallback: use center=median, width = (p99 - p1)
-    arr = get_pixel_array(ds)
-    p1 = np.percentile(arr, 1)
-    p99 = np.percentile(arr, 99)
+    if arr is None:
+        arr = get_pixel_array(ds)
+    p1, p99 = np.percentile(arr, [1, 99])
     center = (p99 + p1) / 2.0
     width = max(1.0, p99 - p1)
     return float(center), float(width)
@@ -151,13 +231,98 @@ def apply_window(img: np.ndarray, center: float, width: float) -> np.ndarray:
     """
     Applies windowing to the image and returns uint8 (0-255).
     Formula: map [c-w/2, c+w/2] -> [0,255], with clipping.
+    All arithmetic is done in place on a single float32 buffer.
     """
-    lower = center - (width / 2.0)
-    upper = center + (width / 2.0)
-    img_w = np.clip(img, lower, upper)
-    img_norm = (img_w - lower) / (upper - lower)
-    img_8 = np.uint8(np.round(img_norm * 255.0))
-    return img_8
+    tmp = np.empty(img.shape, dtype=np.float32)
+    scale = 255.0 / width
+    # +0.5 en el offset: el cast a uint8 (truncado) redondea sin una pasada extra
+    offset = -(center - width / 2.0) * scale + 0.5
+    np.multiply(img, scale, out=tmp)
+    tmp += offset
+    np.clip(tmp, 0.0, 255.0, out=tmp)
+    return tmp.astype(np.uint8)
+
+@st.cache_resource(show_spinner=False)
+def lut_kernels():
+    """
+    Compiles the numba LUT kernels once per server process and warms them up, so
+    the first slider move doesn't pay the JIT cost. Returns (build, gather), or
+    None if numba is not installed.
+    """
+    if njit is None:
+        return None
+
+    @njit
+    def build(n, signed, slope, intercept, center, width, invert, lut):
+        # escala, offset, recorte y cast en una sola pasada
+        scale = 255.0 / width
+        offset = -(center - width / 2.0) * scale + 0.5
+        for i in range(n):
+            v = float(i - n) if signed and i >= n // 2 else float(i)
+            y = (v * slope + intercept) * scale + offset
+            y = min(max(y, 0.0), 255.0)
+            lut[i] = 255 - np.uint8(y) if invert else np.uint8(y)
+
+    @njit(parallel=True)
+    def gather(raw, lut, out):
+        for i in prange(raw.size):
+            out[i] = lut[raw[i]]
+
+    lut = np.empty(65536, dtype=np.uint8)
+    build(65536, False, 1.0, 0.0, 0.0, 1.0, False, lut)
+    out = np.empty(1, dtype=np.uint8)
+    for dtype in (np.uint8, np.uint16):
+        gather(np.zeros(1, dtype=dtype), lut, out)
+    return build, gather
+
+def build_window_lut(center: float, width: float, invert: bool = False, n: int = 65536,
+                     signed: bool = False, slope: float = 1.0, intercept: float = 0.0) -> np.ndarray:
+    """
+    Builds a uint8 LUT with n entries mapping stored pixel values to windowed values.
+    The rescale (slope/intercept) is folded in, so the LUT is indexed by the raw data.
+    For signed data the upper half holds negative values (two's complement order),
+    matching apply_lut's unsigned view of the array.
+    """
+    kernels = lut_kernels()
+    if kernels is not None:
+        lut = np.empty(n, dtype=np.uint8)
+        kernels[0](int(n), bool(signed), float(slope), float(intercept),
+                   float(center), float(width), bool(invert), lut)
+        return lut
+    x = np.arange(n, dtype=np.float32)
+    if signed:
+        x[n // 2:] -= n
+    x *= slope
+    x += intercept
+    lut = apply_window(x, center, width)
+    if invert:
+        np.subtract(255, lut, out=lut)
+    return lut
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def window_lut_cached(center: float, width: float, invert: bool, n: int,
+                      signed: bool, slope: float, intercept: float) -> np.ndarray:
+    """
+    build_window_lut memoized per (center, width, invert, n, signed, slope, intercept).
+    """
+    return build_window_lut(center, width, invert, n=n, signed=signed, slope=slope, intercept=intercept)
+
+def apply_lut(raw: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    """
+    Windows integer data with a single gather: lut[raw].
+    Signed data is reinterpreted (not copied) as unsigned of the same size.
+    Uses the parallel numba kernel when available. The result is always a fresh
+    array because window_cached keeps it in the cache.
+    """
+    if raw.dtype.kind == 'i':
+        raw = raw.view(np.dtype(f"u{raw.dtype.itemsize}"))
+    out = np.empty(raw.shape, dtype=np.uint8)
+    kernels = lut_kernels()
+    if kernels is not None and raw.flags.c_contiguous:
+        kernels[1](raw.reshape(-1), lut, out.reshape(-1))
+    else:
+        np.take(lut, raw, out=out)
+    return out
 
 def to_pil(img_array: np.ndarray) -> Image.Image:
     """
@@ -177,32 +342,133 @@ def to_pil(img_array: np.ndarray) -> Image.Image:
 
 def pil_to_bytes(pil_img: Image.Image, fmt="PNG") -> bytes:
     bio = io.BytesIO()
-    pil_img.save(bio, format=fmt, optimize=True)
+    # compress_level=1: mucho más rápido que optimize=True con archivos apenas más grandes
+    pil_img.save(bio, format=fmt, compress_level=1)
     bio.seek(0)
     return bio.read()
 
+def file_fingerprint(uploaded) -> str:
+    """
+    Cheap fingerprint of the uploaded file (size + first/last 4 KB); used as cache key
+    instead of hashing the whole buffer on every rerun.
+    """
+    buf = uploaded.getbuffer()
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(buf.nbytes).encode())
+    h.update(buf[:4096])
+    h.update(buf[-4096:])
+    return h.hexdigest()
+
+def apply_clahe(img_8: np.ndarray) -> np.ndarray:
+    """
+    Contrast-limited adaptive histogram equalization (CLAHE) of a uint8 image.
+    Uses scikit-image's tiled implementation; without it, falls back to
+    Pillow's global equalization.
+    """
+    if equalize_adapthist is None:
+        return np.asarray(ImageOps.equalize(to_pil(img_8)))
+    out = equalize_adapthist(img_8, clip_limit=0.01)
+    return (out * 255.0 + 0.5).astype(np.uint8)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def window_cached(_arr: np.ndarray, arr_key: str, center: float, width: float,
+                  invert: bool, clahe: bool, _raw: np.ndarray = None,
+                  rescale: tuple = (1.0, 0.0)) -> np.ndarray:
+    """
+    Windowed uint8 image, memoized per (arr_key, center, width, invert, clahe).
+    _arr and _raw are not hashed by Streamlit; arr_key must identify their content.
+    If _raw (see lut_compatible) is given, windowing is done with a LUT on it instead
+    of float arithmetic on _arr.
+    """
+    if _raw is not None:
+        n = 2 ** (8 * _raw.dtype.itemsize)
+        lut = window_lut_cached(center, width, invert, n, _raw.dtype.kind == 'i', *rescale)
+        img_8 = apply_lut(_raw, lut)
+    else:
+        img_8 = apply_window(_arr, center, width)
+        if invert:
+            img_8 = 255 - img_8
+    if clahe:
+        img_8 = apply_clahe(img_8)
+    return img_8
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def encode_png_cached(_img_8: np.ndarray, img_key: tuple) -> bytes:
+    """
+    PNG encoding of the windowed image, memoized per img_key.
+    _img_8 is not hashed by Streamlit; img_key (the window_cached arguments) identifies it.
+    """
+    return pil_to_bytes(to_pil(_img_8), fmt="PNG")
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def array_stats(_arr: np.ndarray, arr_key: str) -> tuple:
+    """
+    (min, max, mean, std, p10, p50, p90) of the pixel array, computed once per frame.
+    _arr is not hashed by Streamlit; arr_key must identify its content.
+    """
+    arr_flat = _arr.ravel()
+    # un solo particionado para todos los percentiles
+    p10, p50, p90 = np.percentile(arr_flat, [10, 50, 90])
+    return (float(arr_flat.min()), float(arr_flat.max()), float(arr_flat.mean()), float(arr_flat.std()),
+            float(p10), float(p50), float(p90))
+
 def show_image(img, caption=None):
     """
     Compatible display handler for different Streamlit versions.
     img can be PIL.Image, numpy array, or file path.
+    The preview is sent to the browser as JPEG (much faster to encode than PNG);
+    the PNG download is lossless.
     """
     try:
-        st.image(img, caption=caption, use_column_width=True)
+        st.image(img, caption=caption, use_column_width=True, output_format="JPEG")
     except TypeError:
         # versiones antiguas: use width en su lugar
-        st.image(img, caption=caption, width=700)
+        st.image(img, caption=caption, width=700, output_format="JPEG")
+
+# Tags DICOM mostrados en la interfaz (keyword -> tag)
+TAGS = {
+    "PatientName": 0x00100010,
+    "PatientID": 0x00100020,
+    "PatientAge": 0x00101010,
+    "PatientSex": 0x00100040,
+    "StudyDate": 0x00080020,
+    "StudyTime": 0x00080030,
+    "Modality": 0x00080060,
+    "InstitutionName": 0x00080080,
+    "PixelSpacing": 0x00280030,
+    "Rows": 0x00280010,
+    "Columns": 0x00280011,
+    "BitsAllocated": 0x00280100,
+    "BitsStored": 0x00280101,
+    "PhotometricInterpretation": 0x00280004,
+    "SamplesPerPixel": 0x00280002,
+    "StudyDescription": 0x00081030,
+    "SeriesDescription": 0x0008103E,
+    "Manufacturer": 0x00080070,
+    "ProtocolName": 0x00181030,
+    "StudyInstanceUID": 0x0020000D,
+    "SeriesInstanceUID": 0x0020000E,
+    "SOPInstanceUID": 0x00080018,
+}
 
-def safe_get(ds, key, default="—"):
-    try:
-        val = getattr(ds, key)
+def read_tags(ds, default="—") -> dict:
+    """
+    Reads every tag in TAGS with a single pass of ds.get(tag) (no exception handling).
+    Returns {keyword: str}; multi-valued elements show their first value and
+    missing or empty elements show default.
+    """
+    values = {}
+    for name, tag in TAGS.items():
+        elem = ds.get(tag)
+        val = None if elem is None else elem.value
         if val is None:
-            return default
+            values[name] = default
         # convert multiple values elegantly
-        if isinstance(val, (list, pydicom.multival.MultiValue, tuple)):
-            return str(val[0])
-        return str(val)
-    except Exception:
-        return default
+        elif isinstance(val, (list, pydicom.multival.MultiValue, tuple)):
+            values[name] = str(val[0]) if len(val) else default
+        else:
+            values[name] = str(val)
+    return values
 
 # ==============================
 # 🧩 UI PRINCIPAL
@@ -242,22 +508,27 @@ def main():
             st.write("Tip: if 'streamlit run verdicom.py' doesn't work, try 'python -m streamlit run verdicom.py' in PowerShell/CMD.")
         return
 
-    # Cargar dataset
-    try:
-        ds = load_dicom(uploaded)
-    except Exception as e:
-        st.error(f"Could not read DICOM file: {e}")
-        return
+    # Cargar dataset: se parsea una sola vez por archivo y se guarda en session_state
+    file_key = file_fingerprint(uploaded)
+    if st.session_state.get("dcm_key") != file_key:
+        try:
+            st.session_state.ds = load_dicom(uploaded)
+        except Exception as e:
+            st.error(f"Could not read DICOM file: {e}")
+            return
+        st.session_state.dcm_key = file_key
+    ds = st.session_state.ds
 
     # Mostrar metadatos
-    patient_name = safe_get(ds, "PatientName")
-    patient_id = safe_get(ds, "PatientID")
-    patient_age = safe_get(ds, "PatientAge")
-    patient_sex = safe_get(ds, "PatientSex")
-    study_date = safe_get(ds, "StudyDate")
-    study_time = safe_get(ds, "StudyTime")
-    modality = safe_get(ds, "Modality")
-    institution = safe_get(ds, "InstitutionName")
+    tags = read_tags(ds)
+    patient_name = tags["PatientName"]
+    patient_id = tags["PatientID"]
+    patient_age = tags["PatientAge"]
+    patient_sex = tags["PatientSex"]
+    study_date = tags["StudyDate"]
+    study_time = tags["StudyTime"]
+    modality = tags["Modality"]
+    institution = tags["InstitutionName"]
 
     # Feature: formatea fecha/hora si es posible
     def fmt_dt(dstr, tstr):
@@ -299,16 +570,13 @@ def main():
     meta_placeholder.markdown(meta_md, unsafe_allow_html=True)
 
     # Detalles técnicos (pixel spacing, dimensions, bits)
-    try:
-        pixel_spacing = safe_get(ds, "PixelSpacing")
-    except Exception:
-        pixel_spacing = "—"
-    rows = getattr(ds, 'Rows', '—')
-    cols = getattr(ds, 'Columns', '—')
-    bits_allocated = getattr(ds, 'BitsAllocated', '—')
-    bits_stored = getattr(ds, 'BitsStored', '—')
-    photometric = getattr(ds, 'PhotometricInterpretation', '—')
-    samples_per_pixel = getattr(ds, 'SamplesPerPixel', '—')
+    pixel_spacing = tags["PixelSpacing"]
+    rows = tags["Rows"]
+    cols = tags["Columns"]
+    bits_allocated = tags["BitsAllocated"]
+    bits_stored = tags["BitsStored"]
+    photometric = tags["PhotometricInterpretation"]
+    samples_per_pixel = tags["SamplesPerPixel"]
     transfer_syntax = "—"
     try:
         transfer_syntax = ds.file_meta.TransferSyntaxUID
@@ -326,76 +594,104 @@ def main():
     tech_placeholder.markdown(tech_md, unsafe_allow_html=True)
 
     # Obtener pixel array y valores default window
-    try:
-        arr = get_pixel_array(ds)
-    except Exception as e:
-        st.error(f"Could not extract pixel_array: {e}")
-        return
+    # se guarda en session_state por hash del archivo para no recalcular en cada rerun
+    if st.session_state.get("arr_key") != file_key:
+        try:
+            # el panel de metadatos ya está pintado; los píxeles se decodifican ahora
+            with col_view, st.spinner("Decoding pixel data..."):
+                volume = get_frames(ds, decode_pixels(uploaded))
+        except Exception as e:
+            st.error(f"Could not extract pixel_array: {e}")
+            return
+        rescale = get_rescale(ds)
+        st.session_state.volume = volume
+        st.session_state.use_lut = lut_compatible(ds, volume)
+        st.session_state.rescale = rescale
+        # frames reescalados bajo demanda (solo los que se visualizan)
+        st.session_state.frames = {}
+        # rango y valores por defecto de WC/WW: fijos por archivo
+        rng = stored_range(ds, rescale) if volume.dtype.kind in 'ui' else None
+        if rng is None:
+            rng = sorted(float(v) * rescale[0] + rescale[1] for v in (volume.min(), volume.max()))
+        lo, hi = rng
+        st.session_state.arr_meta = (lo, hi, *default_window(ds, rescale_array(volume[0], *rescale)))
+        st.session_state.arr_key = file_key
+    volume = st.session_state.volume
+    arr_min, arr_max, default_center, default_width = st.session_state.arr_meta
 
-    # obtener valores por defecto de WC/WW
-    default_center, default_width = default_window(ds)
+    st.sidebar.markdown("## 🛠 Image Controls")
+    # Multi-frame: solo se reescala y ventana el frame seleccionado (slab contiguo)
+    n_frames = volume.shape[0]
+    frame_idx = 0
+    if n_frames > 1:
+        frame_idx = st.sidebar.slider("Frame", min_value=0, max_value=n_frames - 1, value=0)
+    raw = volume[frame_idx]
+    frames = st.session_state.frames
+    if frame_idx not in frames:
+        frames[frame_idx] = rescale_array(raw, *st.session_state.rescale)
+    arr = frames[frame_idx]
+    frame_key = f"{file_key}/{frame_idx}"
 
     # Sliders para Window Center / Width (brillo/contraste)
-    st.sidebar.markdown("## 🛠 Image Controls")
-    wc_slider = st.sidebar.slider("Brightness — Window Center", min_value=float(np.min(arr)), max_value=float(np.max(arr)),
+    wc_slider = st.sidebar.slider("Brightness — Window Center", min_value=arr_min, max_value=arr_max,
                                   value=float(default_center), step=(float(default_width) / 100.0 if default_width else 1.0))
-    ww_slider = st.sidebar.slider("Contrast — Window Width", min_value=1.0, max_value=float(np.max(arr) - np.min(arr) + 1.0),
+    ww_slider = st.sidebar.slider("Contrast — Window Width", min_value=1.0, max_value=arr_max - arr_min + 1.0,
                                   value=float(default_width), step=max(1.0, float(default_width) / 100.0))
 
     # Opción de invertir (para imágenes invertidas)
     invert = st.sidebar.checkbox("Invert scale (White/Black)", value=False)
     # opción de clahe (ecualización adaptativa) como extra
-    clahe_opt = st.sidebar.checkbox("Apply adaptive equalization (CLAHE)", value=False)
+    if equalize_adapthist is not None:
+        clahe_opt = st.sidebar.checkbox("Apply adaptive equalization (CLAHE)", value=False)
+    else:
+        clahe_opt = st.sidebar.checkbox("Apply histogram equalization", value=False,
+                                        help="Install scikit-image for adaptive equalization (CLAHE).")
     # botón para restablecer a DICOM WC/WW (si existen)
     if st.sidebar.button("Reset WC/WW to DICOM values"):
         wc_slider = default_center
         ww_slider = default_width
 
-    # Aplicar windowing
-    img_8 = apply_window(arr, wc_slider, ww_slider)
-    if invert:
-        img_8 = 255 - img_8
-
-    # CLAHE (simple): usar Pillow ImageOps.equalize como alternativa ligera
+    # Aplicar windowing (+ inversión y CLAHE simple), memoizado por parámetros
+    img_key = (frame_key, wc_slider, ww_slider, invert, clahe_opt)
+    img_8 = window_cached(arr, *img_key, raw if st.session_state.use_lut else None,
+                          st.session_state.rescale)
     pil_img = to_pil(img_8)
-    if clahe_opt:
-        try:
-            # PIL no tiene CLAHE nativo sin OpenCV; usar equalize como simplificación
-            pil_img = ImageOps.equalize(pil_img)
-        except Exception:
-            pass
 
     # Mostrar imagen y controles en la columna derecha
     with col_view:
         st.markdown("<div class='viewer-card viewer-image'>", unsafe_allow_html=True)
         st.markdown("### 🖼 DICOM Image")
-        show_image(pil_img, caption=f"WC={wc_slider:.1f}  WW={ww_slider:.1f}")
+        caption = f"WC={wc_slider:.1f}  WW={ww_slider:.1f}"
+        if n_frames > 1:
+            caption += f"  Frame {frame_idx + 1}/{n_frames}"
+        show_image(pil_img, caption=caption)
         st.markdown("---")
 
         # Histogramas y stats
-        with st.expander("📊 Intensity Histogram"):
-            fig, ax = plt.subplots(figsize=(6, 2.6))
-            ax.hist(np.asarray(pil_img).ravel(), bins=256, alpha=0.8)
-            ax.set_xlabel("Intensity")
-            ax.set_ylabel("Frequency")
-            ax.set_title("Histogram (adjusted image)")
-            plt.tight_layout()
-            st.pyplot(fig)
+        # checkbox en vez de expander: el contenido de un expander se ejecuta aunque esté cerrado
+        if st.checkbox("📊 Intensity Histogram", value=False):
+            # datos de 8 bits: bincount es el histograma exacto en una sola pasada
+            counts = np.bincount(img_8.ravel(), minlength=256)
+            st.caption("Histogram (adjusted image)")
+            # gráfico nativo: se envían los conteos, el navegador lo dibuja
+            try:
+                st.bar_chart({"Frequency": counts}, x_label="Intensity", y_label="Frequency", height=220)
+            except TypeError:
+                # versiones antiguas: sin x_label/y_label
+                st.bar_chart({"Frequency": counts}, height=220)
         st.markdown("</div>", unsafe_allow_html=True)
 
-    # Descarga de la imagen ajustada (PNG)
-    png_bytes = pil_to_bytes(pil_img, fmt="PNG")
-    b64 = base64.b64encode(png_bytes).decode()
+    # Descarga de la imagen ajustada (PNG); los bytes se generan solo al hacer clic
     filename = f"verdicom_{patient_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-    st.sidebar.download_button("⬇️ Download Image (PNG)", data=png_bytes, file_name=filename, mime="image/png")
+    def make_png():
+        return encode_png_cached(img_8, img_key)
+    # versiones antiguas: data no acepta callables, se codifica en el momento
+    png_data = make_png if _DEFERRED_DOWNLOAD else make_png()
+    st.sidebar.download_button("⬇️ Download Image (PNG)", data=png_data, file_name=filename, mime="image/png")
 
     # Mostrar algunos valores numéricos y percentiles
-    with st.expander("📈 Quick Statistics"):
-        arr_flat = arr.ravel()
-        p10 = np.percentile(arr_flat, 10)
-        p50 = np.percentile(arr_flat, 50)
-        p90 = np.percentile(arr_flat, 90)
-        mn = np.min(arr_flat); mx = np.max(arr_flat); mean = np.mean(arr_flat); std = np.std(arr_flat)
+    if st.checkbox("📈 Quick Statistics", value=False):
+        mn, mx, mean, std, p10, p50, p90 = array_stats(arr, frame_key)
         stats_md = f"""
 - Min / Max: **{mn:.2f}** / **{mx:.2f}**  
 - Mean / Std: **{mean:.2f}** / **{std:.2f}**  
@@ -410,7 +706,7 @@ def main():
                 "ProtocolName", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"]
         table_md = "|Tag|Valor|\n|---:|:---|\n"
         for k in keys:
-            table_md += f"|{k}|{safe_get(ds, k)}|\n"
+            table_md += f"|{k}|{tags[k]}|\n"
         st.markdown(table_md)
 
     # Footer (pequeña ayuda)